@@ -6,16 +6,33 @@
 from pathlib import Path
 import sys,os
 import argparse
+import contextlib
+import gc
 import logging
+import multiprocessing
 import sys
 import typing as T
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from timeit import default_timer as timer
 
 import torch
+import torch.nn.functional as F
+from torch.nn.attention import SDPBackend, sdpa_kernel
+
+try:
+    import pyfastx
+except ImportError:
+    pyfastx = None
 
 import esm
-from esm.data import read_fasta
+from esm.esmfold.v1.esmfold import ESMFold
+from esm.esmfold.v1.misc import batch_encode_sequences
+from esm.multihead_attention import MultiheadAttention
+
+from pdb_writer import format_pdb, init_pdb_worker
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -33,60 +50,457 @@ logger.addHandler(console_handler)
 
 PathLike = T.Union[str, Path]
 
+DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16, "fp32": torch.float32}
 
-def enable_cpu_offloading(model):
-    from torch.distributed.fsdp import CPUOffload, FullyShardedDataParallel
-    from torch.distributed.fsdp.wrap import enable_wrap, wrap
+ESMFOLD_CHECKPOINT = "esmfold_3B_v1.pt"
+
+# The only outputs copied back to the host: what `output_to_pdb` reads, plus the logged confidences.
+# Pair representations and logits (L x L per sequence) never leave the GPU, and of the structure
+# module's per-iteration `positions` only the last iteration is copied.
+PDB_OUTPUT_KEYS = (
+    "positions", "aatype", "atom37_atom_exists", "residx_atom37_to_atom14", "residue_index", "plddt",
+    "chain_index",
+)
+HOST_OUTPUT_KEYS = PDB_OUTPUT_KEYS + ("mean_plddt", "ptm")
+
+# PDB formatting moves to a process pool only for inputs large enough to amortize starting it.
+MIN_SEQUENCES_FOR_PDB_POOL = 64
+MAX_PDB_WORKERS = 4
+
+
+def load_esmfold(model_dir: T.Optional[Path] = None):
+    # ESM-2 is resolved through the torch.hub cache when ESMFold is constructed, so point the hub at
+    # `model_dir`. The ESMFold checkpoint itself is loaded straight from disk. It is memory-mapped, so
+    # `load_state_dict` copies from the file's pages instead of from a second full copy in RAM.
+    if model_dir is None:
+        return esm.pretrained.esmfold_v1()
+
+    torch.hub.set_dir(model_dir)
+    candidates = [model_dir / "checkpoints" / ESMFOLD_CHECKPOINT, model_dir / ESMFOLD_CHECKPOINT]
+    model_path = next((path for path in candidates if path.exists()), None)
+    if model_path is None:
+        return esm.pretrained.esmfold_v1()
+
+    # Only checkpoints in the zipfile format (the default since PyTorch 1.6) can be memory-mapped.
+    mmap = zipfile.is_zipfile(model_path)
+    model_data = torch.load(model_path, map_location="cpu", mmap=mmap, weights_only=False)
+
+    model = ESMFold(esmfold_config=model_data["cfg"]["model"])
+    missing_keys = set(model.state_dict()) - set(model_data["model"])
+    missing_essential_keys = [key for key in missing_keys if not key.startswith("esm.")]
+    if missing_essential_keys:
+        raise RuntimeError(f"Keys '{', '.join(missing_essential_keys)}' are missing.")
+    model.load_state_dict(model_data["model"], strict=False)
+    return model
 
-    torch.distributed.init_process_group(
-        backend="nccl", init_method="tcp://localhost:9999", world_size=1, rank=0
+
+def _sdpa_self_attention_forward(
+    self, query, key, value, key_padding_mask=None, need_weights=True, need_head_weights=False,
+    attn_mask=None, **kwargs
+):
+    # ESM-2's MultiheadAttention materializes softmax(QK^T)V by hand since rotary embeddings keep it
+    # off the fused torch path. Compute the same attention with `F.scaled_dot_product_attention` so
+    # PyTorch can dispatch to its FlashAttention-2 / memory-efficient kernels (O(L) memory). Attention
+    # weights are never materialized; ESM-2 only consumes them when `need_head_weights` is set, in
+    # which case we fall back to the original implementation.
+    if need_head_weights or attn_mask is not None or kwargs or self.training or self.bias_k is not None:
+        return MultiheadAttention.forward(
+            self, query, key, value, key_padding_mask=key_padding_mask, need_weights=need_weights,
+            need_head_weights=need_head_weights, attn_mask=attn_mask, **kwargs
+        )
+
+    tgt_len, bsz, embed_dim = query.size()
+    # (T, B, C) -> (B, H, T, D)
+    q, k, v = (
+        proj(query).view(tgt_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+        for proj in (self.q_proj, self.k_proj, self.v_proj)
     )
+    q = q * self.scaling
+    if self.rot_emb:
+        # The rotary tables may be kept in higher precision than the projections (see `cast_esm`).
+        q, k = (t.to(v.dtype) for t in self.rot_emb(q, k))
+
+    mask = None
+    if key_padding_mask is not None and key_padding_mask.dim() > 0:
+        mask = ~key_padding_mask.to(torch.bool)[:, None, None, :]
+
+    attn = F.scaled_dot_product_attention(q, k, v, attn_mask=mask, scale=1.0)
+    attn = attn.permute(2, 0, 1, 3).reshape(tgt_len, bsz, embed_dim)
+    return self.out_proj(attn), None
+
+
+def cast_esm(model, dtype):
+    # Casts the ESM-2 weights, but keeps the rotary `inv_freq` buffers in fp32. In reduced precision the
+    # rotary angles (position x frequency) lose most of their mantissa at long sequence lengths.
+    model.to(dtype)
+    for layer in model.layers:
+        rot_emb = layer.self_attn.rot_emb
+        if rot_emb is not None:
+            rot_emb.inv_freq = rot_emb.inv_freq.float()
+            rot_emb._seq_len_cached = None
+    return model
+
+
+def enable_sdpa_attention(model):
+    for layer in model.layers:
+        layer.self_attn.forward = _sdpa_self_attention_forward.__get__(layer.self_attn)
+    return model
 
-    wrapper_kwargs = dict(cpu_offload=CPUOffload(offload_params=True))
 
-    with enable_wrap(wrapper_cls=FullyShardedDataParallel, **wrapper_kwargs):
-        for layer_name, layer in model.layers.named_children():
-            wrapped_layer = wrap(layer)
-            setattr(model.layers, layer_name, wrapped_layer)
-        model = wrap(model)
+class CUDAGraphLayers:
+    # A CUDA graph of the whole ESM-2 layer stack, captured once per input shape and replayed for every
+    # later batch of that shape, so the stack costs one graph launch instead of hundreds of small kernel
+    # launches. Inputs are padded to a multiple of `pad_multiple` tokens and `row_multiple` rows so that
+    # shapes recur across batches; both multiples are kept small, since every padded token and row is
+    # computed by all layers of the 3B model. Padded tokens are masked, padded rows are zeros with no padding
+    # mask (a fully masked row would turn the attention softmax into NaNs) and are sliced off again.
+    # The rest of ESMFold is not captured: its forward synchronizes with the host (per-sequence pTM
+    # slicing, numpy-backed atom masks), which is not allowed during capture.
+    # The graph runs when the first layer is called; the other layers return its stored outputs as long
+    # as they are called in order on the previous layer's output, and run eagerly otherwise.
+    def __init__(self, layers, max_shapes=4, pad_multiple=8, row_multiple=4):
+        self.layers = list(layers)
+        self.max_shapes = max_shapes
+        self.pad_multiple = pad_multiple
+        self.row_multiple = row_multiple
+        self.enabled = True
+        self.shapes = OrderedDict()
+        self.outputs = None
+
+    def clear(self):
+        # Frees the graphs and their memory pools, e.g. before retrying a batch that ran out of memory.
+        self.shapes.clear()
+        self.outputs = None
+
+    def run(self, layer_idx, x, padding_mask):
+        if layer_idx > 0:
+            if self.outputs is not None and x is self.outputs[layer_idx - 1][0]:
+                return self.outputs[layer_idx]
+            return self.layers[layer_idx](x, self_attn_padding_mask=padding_mask)
+
+        self.outputs = None
+        if not self.enabled:
+            return self.layers[0](x, self_attn_padding_mask=padding_mask)
+        seq_len, batch_size, embed_dim = x.shape
+        key = (
+            -(-seq_len // self.pad_multiple) * self.pad_multiple,
+            -(-batch_size // self.row_multiple) * self.row_multiple,
+            x.dtype,
+        )
+        if key not in self.shapes:
+            if len(self.shapes) >= self.max_shapes:
+                self.shapes.popitem(last=False)
+            self.shapes[key] = self.capture(key[0], key[1], x)
+        self.shapes.move_to_end(key)
+        if self.shapes[key] is None:
+            return self.layers[0](x, self_attn_padding_mask=padding_mask)
+        static_x, static_mask, graph, static_outputs, _ = self.shapes[key]
+
+        static_x.zero_()
+        static_x[:seq_len, :batch_size].copy_(x)
+        static_mask.fill_(False)
+        static_mask[:batch_size, seq_len:] = True
+        if padding_mask is not None:
+            static_mask[:batch_size, :seq_len].copy_(padding_mask)
+        graph.replay()
+        self.outputs = [(out[:seq_len, :batch_size], attn) for out, attn in static_outputs]
+        return self.outputs[0]
+
+    def capture(self, padded_len, padded_batch_size, x):
+        # Returns None if the shape cannot be captured (e.g. out of memory), which runs it eagerly.
+        static_x = x.new_zeros(padded_len, padded_batch_size, x.shape[2])
+        static_mask = torch.zeros(padded_batch_size, padded_len, dtype=torch.bool, device=x.device)
+
+        def run_layers():
+            outputs, h = [], static_x
+            for layer in self.layers:
+                h, attn = layer(h, self_attn_padding_mask=static_mask)
+                outputs.append((h, attn))
+            return outputs
+
+        try:
+            # torch.cuda.graph requires a warmup run on a side stream before capturing.
+            side_stream = torch.cuda.Stream()
+            side_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(side_stream):
+                run_layers()
+            torch.cuda.current_stream().wait_stream(side_stream)
+
+            graph = torch.cuda.CUDAGraph()
+            # Autocast must not cache weight casts inside a graph. Capture errors are thread local since
+            # the PDB writer thread may synchronize on CUDA events while the graph is being captured.
+            with torch.autocast(
+                "cuda", dtype=torch.get_autocast_dtype("cuda"), enabled=torch.is_autocast_enabled("cuda"),
+                cache_enabled=False
+            ):
+                with torch.cuda.graph(graph, capture_error_mode="thread_local"):
+                    static_outputs = run_layers()
+        except RuntimeError as e:
+            logger.warning(
+                f"Failed to capture CUDA graph for shape {(padded_len, padded_batch_size)}, running it eagerly: {e}"
+            )
+            return None
+        # The graph reads the rotary tables cached for this length; keep them alive once the layers
+        # recompute their caches for another length.
+        rotary_tables = [
+            (layer.self_attn.rot_emb._cos_cached, layer.self_attn.rot_emb._sin_cached)
+            for layer in self.layers if layer.self_attn.rot_emb is not None
+        ]
+        return static_x, static_mask, graph, static_outputs, rotary_tables
+
+
+class CUDAGraphTransformerLayer(torch.nn.Module):
+    def __init__(self, layer, layer_idx, graphs):
+        super().__init__()
+        self.layer = layer
+        self.layer_idx = layer_idx
+        self.graphs = graphs
+
+    def forward(self, x, self_attn_mask=None, self_attn_padding_mask=None, need_head_weights=False):
+        if need_head_weights or self_attn_mask is not None or not x.is_cuda:
+            return self.layer(
+                x, self_attn_mask=self_attn_mask, self_attn_padding_mask=self_attn_padding_mask,
+                need_head_weights=need_head_weights
+            )
+        return self.graphs.run(self.layer_idx, x, self_attn_padding_mask)
+
+
+def enable_cuda_graphs(model):
+    # Returns the graph registry, which is also attached to `model` as `cuda_graphs`.
+    graphs = CUDAGraphLayers(model.layers)
+    for layer_idx, layer in enumerate(model.layers):
+        model.layers[layer_idx] = CUDAGraphTransformerLayer(layer, layer_idx, graphs)
+    model.cuda_graphs = graphs
+    return graphs
+
+
+def enable_cpu_offloading(model):
+    # Single-process parameter offload for the ESM-2 layers: each layer's weights stay in pinned host
+    # memory and are copied to the GPU right before the layer runs, then dropped again after it. This
+    # is what FSDP's CPUOffload provided here, without a NCCL process group or per-layer all-gathers.
+    # Weights are never updated during inference, so offloading only has to swap back to the host copy.
+    for layer in model.layers:
+        tensors = list(layer.parameters()) + list(layer.buffers())
+        for tensor in tensors:
+            tensor.data = tensor.data.pin_memory()
+        host_data = [tensor.data for tensor in tensors]
+
+        def load_layer(module, args, tensors=tensors, host_data=host_data):
+            for tensor, data in zip(tensors, host_data):
+                tensor.data = data.to("cuda", non_blocking=True)
+
+        def offload_layer(module, args, output, tensors=tensors, host_data=host_data):
+            for tensor, data in zip(tensors, host_data):
+                tensor.data = data
+
+        layer.register_forward_pre_hook(load_layer)
+        layer.register_forward_hook(offload_layer)
 
     return model
 
 
 def init_model_on_gpu_with_cpu_offloading(model):
     model = model.eval()
-    model_esm = enable_cpu_offloading(model.esm)
-    del model.esm
+    esm_layers = model.esm.layers
+    model.esm.layers = torch.nn.ModuleList()
     model.cuda()
-    model.esm = model_esm
+    model.esm.layers = esm_layers
+    enable_cpu_offloading(model.esm)
     return model
 
 
 def create_batched_sequence_datasest(
-    sequences: T.List[T.Tuple[str, str]], max_tokens_per_batch: int = 1024
+    sequences: T.List[T.Tuple[str, str]], max_tokens_per_batch: int = 1024, bucket_width: int = 32
 ) -> T.Generator[T.Tuple[T.List[str], T.List[str]], None, None]:
+    # ESMFold pads every sequence to the longest one in the batch, so the budget is spent on
+    # padded tokens (batch size x max length). Sequences are grouped into length buckets of
+    # `bucket_width` residues so that a batch never mixes very short and very long sequences.
 
-    batch_headers, batch_sequences, num_tokens = [], [], 0
-    # for header, seq in sequences:
-    #     if (len(seq) + num_tokens > max_tokens_per_batch) and num_tokens > 0:
-    #         yield batch_headers, batch_sequences
-    #         batch_headers, batch_sequences, num_tokens = [], [], 0
-    #     batch_headers.append(header)
-    #     batch_sequences.append(seq)
-    #     num_tokens += len(seq)
+    batch_headers, batch_sequences, max_len, bucket = [], [], 0, None
     for header, seq in sequences:
-        if len(seq) + num_tokens <= max_tokens_per_batch:
-            batch_headers.append(header)
-            batch_sequences.append(seq)
-            num_tokens += len(seq)
-        else:
+        seq_bucket = len(seq) // bucket_width
+        padded_tokens = (len(batch_sequences) + 1) * max(max_len, len(seq))
+        if batch_sequences and (padded_tokens > max_tokens_per_batch or seq_bucket != bucket):
             yield batch_headers, batch_sequences
-            batch_headers, batch_sequences, num_tokens = [], [], 0
-            batch_headers.append(header)
-            batch_sequences.append(seq)
-            num_tokens += len(seq)
+            batch_headers, batch_sequences, max_len = [], [], 0
+        if len(seq) > max_tokens_per_batch:
+            # A sequence that alone exceeds the budget is predicted on its own.
+            yield [header], [seq]
+            continue
+        batch_headers.append(header)
+        batch_sequences.append(seq)
+        max_len = max(max_len, len(seq))
+        bucket = seq_bucket
+
+    if batch_headers:
+        yield batch_headers, batch_sequences
+
+
+MIN_CHUNK_SIZE = 32
+
+
+def select_chunk_size(max_len: int) -> T.Optional[int]:
+    # Only chunk axial attention when the batch is long enough for activation memory to matter.
+    if max_len < 512:
+        return None
+    if max_len < 1024:
+        return 128
+    if max_len < 2048:
+        return 64
+    return MIN_CHUNK_SIZE
+
+
+def is_cuda_oom(e: RuntimeError) -> bool:
+    return isinstance(e, torch.cuda.OutOfMemoryError) or str(e).startswith("CUDA out of memory")
+
+
+def encode_batch(sequences, pin_memory=False):
+    # Tokenizes and pads a batch once, exactly like `ESMFold.infer` does, so that chunk-size retries
+    # and batch splits reuse the tensors instead of re-encoding the python strings.
+    aatype, mask, residx, linker_mask, chain_index = batch_encode_sequences(sequences)
+    batch = dict(aatype=aatype, mask=mask, residx=residx, linker_mask=linker_mask, chain_index=chain_index)
+    if pin_memory:
+        batch = {key: value.pin_memory() for key, value in batch.items()}
+    return batch
 
-    yield batch_headers, batch_sequences
+
+def slice_batch(batch, index):
+    # Selects rows of an encoded batch and trims the padding to the longest remaining sequence.
+    batch = {key: value[index] for key, value in batch.items()}
+    max_len = int(batch["mask"].sum(dim=1).max())
+    return {key: value[:, :max_len] for key, value in batch.items()}
+
+
+def forward_encoded(model, batch, num_recycles):
+    # Same as `ESMFold.infer`, starting from a batch produced by `encode_batch`.
+    aatype, mask, residx, linker_mask = (
+        batch[key].to(model.device, non_blocking=True) for key in ("aatype", "mask", "residx", "linker_mask")
+    )
+    output = model(aatype, mask=mask, residx=residx, num_recycles=num_recycles)
+    output["atom37_atom_exists"] = output["atom37_atom_exists"] * linker_mask.unsqueeze(2)
+    output["mean_plddt"] = (output["plddt"] * output["atom37_atom_exists"]).sum(
+        dim=(1, 2)
+    ) / output["atom37_atom_exists"].sum(dim=(1, 2))
+    output["chain_index"] = batch["chain_index"]
+    return output
+
+
+def copy_output_to_host(output):
+    # Every tensor is copied into page-locked host memory with a non-blocking copy, so all transfers are
+    # queued on the current stream and the caller synchronizes once before reading them. Pinned blocks
+    # are recycled by PyTorch's caching host allocator, so recurring bucket shapes reuse host buffers.
+    # Reduced-precision outputs are upcast on device: PDB writing goes through numpy, which has no bfloat16.
+    host_output = {}
+    for key, value in output.items():
+        if value.is_floating_point():
+            value = value.float()
+        if value.is_cuda:
+            host_value = torch.empty(value.shape, dtype=value.dtype, pin_memory=True)
+            value = host_value.copy_(value, non_blocking=True)
+        host_output[key] = value
+    return host_output
+
+
+def infer_with_chunk_retry(model, batch, num_recycles, chunk_size):
+    # On CUDA OOM, retry with half the chunk size until MIN_CHUNK_SIZE has been tried. The error is
+    # re-raised once that fails too, so by then the smallest chunk size reached is
+    # `smallest_chunk_size(chunk_size)`.
+    while True:
+        model.set_chunk_size(chunk_size)
+        try:
+            return forward_encoded(model, batch, num_recycles)
+        except RuntimeError as e:
+            if not is_cuda_oom(e) or (chunk_size is not None and chunk_size <= MIN_CHUNK_SIZE):
+                raise
+            chunk_size = 128 if chunk_size is None else max(chunk_size // 2, MIN_CHUNK_SIZE)
+            logger.info(f"CUDA out of memory, retrying with chunk size {chunk_size}.")
+            torch.cuda.empty_cache()
+
+
+def smallest_chunk_size(chunk_size):
+    return MIN_CHUNK_SIZE if chunk_size is None else min(chunk_size, MIN_CHUNK_SIZE)
+
+
+def safe_infer(model, headers, sequences, batch, num_recycles, chunk_size, start=None):
+    # Returns a list of (headers, sequences, host output, start time) predictions. If the batch still
+    # runs out of memory at the smallest chunk size, it is split in half and each half is predicted
+    # separately, starting at that chunk size, so only sequences that do not fit on their own are
+    # dropped. Each half is timed from the start of its own prediction.
+    if start is None:
+        start = timer()
+    try:
+        output = infer_with_chunk_retry(model, batch, num_recycles, chunk_size)
+        output = {key: output[key] for key in HOST_OUTPUT_KEYS}
+        output["positions"] = output["positions"][-1:]
+        return [(headers, sequences, copy_output_to_host(output), start)]
+    except RuntimeError as e:
+        if not is_cuda_oom(e):
+            raise
+    # Retry outside of the except block so the traceback does not keep the failed activations alive.
+    # Captured CUDA graphs hold their own memory pools; drop them so the retry can use that memory.
+    cuda_graphs = getattr(model.esm, "cuda_graphs", None)
+    if cuda_graphs is not None:
+        cuda_graphs.clear()
+    gc.collect()
+    torch.cuda.empty_cache()
+    if len(sequences) == 1:
+        logger.info(f"Failed (CUDA out of memory) on sequence {headers[0]} of length {len(sequences[0])}.")
+        return []
+    half = len(sequences) // 2
+    chunk_size = smallest_chunk_size(chunk_size)
+    logger.info(f"Failed (CUDA out of memory) to predict batch of size {len(sequences)}, splitting it in two.")
+    return (
+        safe_infer(
+            model, headers[:half], sequences[:half], slice_batch(batch, slice(None, half)), num_recycles, chunk_size
+        )
+        + safe_infer(
+            model, headers[half:], sequences[half:], slice_batch(batch, slice(half, None)), num_recycles, chunk_size
+        )
+    )
+
+
+def create_pdb_executor(num_sequences):
+    # Forked, not spawned, so workers start without re-importing torch and esm. This must run before the
+    # process initializes CUDA or starts any thread; with fork, all workers are started on the first
+    # submit, so submit a no-op right away. Returns None (format in the writer thread) for small inputs.
+    if num_sequences < MIN_SEQUENCES_FOR_PDB_POOL:
+        return None
+    num_workers = min(MAX_PDB_WORKERS, max(1, len(os.sched_getaffinity(0)) // 2))
+    pdb_executor = ProcessPoolExecutor(
+        max_workers=num_workers, mp_context=multiprocessing.get_context("fork"), initializer=init_pdb_worker
+    )
+    pdb_executor.submit(int).result()
+    return pdb_executor
+
+
+def write_pdbs(output, headers, pdb_dir, start, copy_done=None, pdb_executor=None):
+    # Runs on a worker thread so PDB serialization and disk IO overlap with the next forward pass.
+    # `copy_done` is the CUDA event recorded after the non-blocking device-to-host copy of `output`.
+    # Each sequence is formatted and written on `pdb_executor` (a process pool, which avoids the GIL)
+    # when one is given. Outputs are sliced as numpy arrays so only that sequence's data is pickled.
+    if copy_done is not None:
+        copy_done.synchronize()
+    output = {key: output[key].numpy() for key in PDB_OUTPUT_KEYS}
+    futures = []
+    for i, header in enumerate(headers):
+        seq_id = header.split()[0]
+        output_file = pdb_dir / f"{seq_id}.pdb"
+        seq_output = {key: value[i : i + 1] for key, value in output.items()}
+        seq_output["positions"] = output["positions"][:, i : i + 1]
+        if pdb_executor is None:
+            format_pdb(seq_output, output_file)
+        else:
+            futures.append(pdb_executor.submit(format_pdb, seq_output, output_file))
+    for future in futures:
+        future.result()
+    return timer() - start
+
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value}")
+    return number
 
 
 def create_parser():
@@ -118,6 +532,13 @@ def create_parser():
         "for batched prediction. Lowering this can help with out of memory issues, if these occur on "
         "short sequences.",
     )
+    parser.add_argument(
+        "--bucket-width",
+        type=positive_int,
+        default=32,
+        help="Width (in residues) of the length buckets used for batching. Only sequences from the same "
+        "bucket are batched together, which limits the compute wasted on padding.",
+    )
     parser.add_argument(
         "--chunk-size",
         type=int,
@@ -125,118 +546,152 @@ def create_parser():
         help="Chunks axial attention computation to reduce memory usage from O(L^2) to O(L). "
         "Equivalent to running a for loop over chunks of of each dimension. Lower values will "
         "result in lower memory usage at the cost of speed. Recommended values: 128, 64, 32. "
-        "Default: None.",
+        "Default: None, which picks a chunk size per batch from its longest sequence.",
+    )
+    parser.add_argument(
+        "--dtype",
+        choices=sorted(DTYPES),
+        default=None,
+        help="Precision of the ESM-2 weights and, for bf16/fp16, of an autocast region around inference "
+        "on GPU. Default: None, which keeps ESM-2 in fp16 as shipped and runs the folding trunk in fp32. "
+        "Ignored with --cpu-only.",
+    )
+    parser.add_argument(
+        "--cuda-graphs",
+        help="Replay the ESM-2 layers from CUDA graphs captured per batch shape, padded to a multiple of 8 "
+        "tokens and 4 sequences. Costs extra GPU memory for up to 4 captured shapes. Experimental: the "
+        "speedup has not been measured, and the padding may cost more than the saved kernel launches. "
+        "Not supported with --cpu-only or --cpu-offload.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--compile",
+        help="Compile the folding trunk with torch.compile to fuse its pointwise ops. The first batches of "
+        "each new shape pay the compilation time, so this only pays off on large inputs.",
+        action="store_true",
     )
     parser.add_argument("--cpu-only", help="CPU only", action="store_true")
     parser.add_argument("--cpu-offload", help="Enable CPU offloading", action="store_true")
     return parser
 
 
-def parse_fasta(file_path):
-    sequences = []
-    with open(file_path, 'r') as f:
-        seq_id = None
-        seq = []
-        annotations = {}
-        for line in f:
-            line = line.strip()
-            if line.startswith(">"):
-                if seq_id:
-                    sequences.append({
-                        'id': seq_id,
-                        'seq': ''.join(seq),
-                        'annotations': annotations
-                    })
-                header = line[1:].split()
-                seq_id = header[0]
-                annotations = {k: v for k, v in (item.split('=') for item in header[1:])}
-                seq = []
-            else:
-                seq.append(line)
-        if seq_id:
-            sequences.append({
-                'id': seq_id,
-                'seq': ''.join(seq),
-                'annotations': annotations
-            })
-    return sequences
-
-def write_fasta(sequences, file_path):
-    with open(file_path, 'w') as f:
-        for seq in sequences:
-            annotations = ' '.join(f"{k}={v}" for k, v in seq['annotations'].items())
-            f.write(f">{seq['id']} {annotations}\n")
-            f.write(f"{seq['seq']}\n")
+def read_fasta_records(file_path):
+    # Returns (header, sequence) pairs in file order. Uses pyfastx's C parser when it is installed and
+    # otherwise splits the whole file at once; both are much faster than reading line by line in Python.
+    # Both readers accept the same files: an empty file has no records, while text before the first
+    # header or a record without an ID raises a ValueError.
+    with open(file_path) as f:
+        first_line = next((line for line in f if line.strip()), None)
+    if first_line is None:
+        return []
+    if not first_line.startswith(">"):
+        raise ValueError(f"{file_path} is not a FASTA file: expected '>' before {first_line.strip()!r}")
+
+    if pyfastx is not None:
+        records = [
+            (f"{name} {comment}" if comment else name, seq)
+            for name, seq, comment in pyfastx.Fastx(str(file_path), comment=True)
+        ]
+    else:
+        records = []
+        for entry in Path(file_path).read_text().lstrip()[1:].split("\n>"):
+            header, _, body = entry.partition("\n")
+            records.append((header.strip(), "".join(body.split())))
+
+    for index, (header, _) in enumerate(records):
+        if not header:
+            raise ValueError(f"Record {index + 1} of {file_path} has an empty header")
+    return records
+
+
+def _parse_header(header):
+    seq_id, *items = header.split()
+    annotations = {}
+    for item in items:
+        if '=' in item:
+            k, v = item.split('=', 1)
+            annotations[k] = v
+        else:
+            annotations[item] = True
+    return seq_id, annotations
+
+
+def _format_header(seq_id, annotations):
+    items = [k if v is True else f"{k}={v}" for k, v in annotations.items()]
+    return ' '.join([seq_id, *items])
 
 
 def run(args):
     if not args.fasta.exists():
         raise FileNotFoundError(args.fasta)
 
+    # Inference only: no autograd bookkeeping anywhere in this script.
+    torch.set_grad_enabled(False)
+    # Bucketed batching makes input shapes recur, so autotuning cudnn kernels once per shape pays off.
+    torch.backends.cudnn.benchmark = True
+
     args.pdb.mkdir(exist_ok=True)
 
-    # Read fasta and sort sequences by length
+    # Read fasta and sort sequences by length, longest first: out of memory errors surface in the first
+    # batches, and later (smaller) batches reuse blocks the caching allocator has already reserved.
     logger.info(f"Reading sequences from {args.fasta}")
-    all_sequences = sorted(read_fasta(args.fasta), key=lambda header_seq: len(header_seq[1]))
+    records = read_fasta_records(args.fasta)
+    all_sequences = sorted(records, key=lambda header_seq: len(header_seq[1]), reverse=True)
     logger.info(f"Loaded {len(all_sequences)} sequences from {args.fasta}")
+    pdb_executor = create_pdb_executor(len(all_sequences))
 
     logger.info("Loading model")
 
-    # Use pre-downloaded ESM weights from model_pth.
-    if args.model_dir is not None:
-        # if pretrained model path is available
-        torch.hub.set_dir(args.model_dir)
-
-    model = esm.pretrained.esmfold_v1()
+    # Use pre-downloaded ESM weights from model_dir if available.
+    model = load_esmfold(args.model_dir)
 
     model = model.eval()
-    model.set_chunk_size(args.chunk_size)
+    enable_sdpa_attention(model.esm)
 
     if args.cpu_only:
         model.esm.float()  # convert to fp32 as ESM-2 in fp16 is not supported on CPU
         model.cpu()
-    elif args.cpu_offload:
-        model = init_model_on_gpu_with_cpu_offloading(model)
     else:
-        model.cuda()
+        if args.dtype is not None:
+            logger.info(f"Running inference in {args.dtype}")
+            cast_esm(model.esm, DTYPES[args.dtype])
+        if args.cpu_offload:
+            model = init_model_on_gpu_with_cpu_offloading(model)
+        else:
+            model.cuda()
+    cuda_graphs = None
+    if args.cuda_graphs:
+        if args.cpu_only or args.cpu_offload:
+            logger.warning("CUDA graphs are not supported with --cpu-only or --cpu-offload, ignoring --cuda-graphs")
+        else:
+            cuda_graphs = enable_cuda_graphs(model.esm)
+    if args.compile:
+        logger.info("Compiling the folding trunk")
+        model.trunk = torch.compile(model.trunk, dynamic=True)
+    use_autocast = not args.cpu_only and args.dtype in ("bf16", "fp16")
+    autocast_dtype = DTYPES[args.dtype] if use_autocast else torch.float32
     logger.info("Starting Predictions")
-    batched_sequences = create_batched_sequence_datasest(all_sequences, args.max_tokens_per_batch)
+    batched_sequences = create_batched_sequence_datasest(
+        all_sequences, args.max_tokens_per_batch, args.bucket_width
+    )
 
     num_completed = 0
+    pLDDT_sum, pTM_sum = 0.0, 0.0
     num_sequences = len(all_sequences)
     pLDDT_dict = {}
     pTM_dict = {}
-    for headers, sequences in batched_sequences:
-        start = timer()
-        try:
-            output = model.infer(sequences, num_recycles=args.num_recycles)
-        except RuntimeError as e:
-            if e.args[0].startswith("CUDA out of memory"):
-                if len(sequences) > 1:
-                    logger.info(
-                        f"Failed (CUDA out of memory) to predict batch of size {len(sequences)}. "
-                        "Try lowering `--max-tokens-per-batch`."
-                    )
-                else:
-                    logger.info(
-                        f"Failed (CUDA out of memory) on sequence {headers[0]} of length {len(sequences[0])}."
-                    )
 
-                continue
-            raise
-
-        output = {key: value.cpu() for key, value in output.items()}
-        pdbs = model.output_to_pdb(output)
-        tottime = timer() - start
+    def log_batch(future, headers, sequences, output):
+        nonlocal num_completed, pLDDT_sum, pTM_sum
+        tottime = future.result()
         time_string = f"{tottime / len(headers):0.1f}s"
         if len(sequences) > 1:
             time_string = time_string + f" (amortized, batch size {len(sequences)})"
-        for header, seq, pdb_string, mean_plddt, ptm in zip(
-            headers, sequences, pdbs, output["mean_plddt"], output["ptm"]
-        ):
+        pLDDT_sum += output["mean_plddt"].sum().item()
+        pTM_sum += output["ptm"].sum().item()
+        mean_plddts, ptms = output["mean_plddt"].tolist(), output["ptm"].tolist()
+        for header, seq, mean_plddt, ptm in zip(headers, sequences, mean_plddts, ptms):
             seq_id = header.split()[0]
-            output_file = args.pdb / f"{seq_id}.pdb"
-            output_file.write_text(pdb_string)
             num_completed += 1
             pLDDT_dict[seq_id] = mean_plddt
             pTM_dict[seq_id] = ptm
@@ -245,19 +700,82 @@ def run(args):
                 f"pTM {ptm:0.3f} in {time_string}. "
                 f"{num_completed} / {num_sequences} completed."
             )
-    avg_pLDDT = sum(pLDDT_dict.values()) / num_completed
-    avg_pTM = sum(pTM_dict.values()) / num_completed
+
+    # Inference runs on a dedicated stream and its outputs are copied back without blocking, while the
+    # previous batch is handed to a worker thread that writes its PDBs, fanning them out to the PDB
+    # process pool on large inputs (double buffering).
+    stream_compute = None if args.cpu_only else torch.cuda.Stream()
+    executor = ThreadPoolExecutor(max_workers=1)
+    pending = None
+    # On GPU, restrict SDPA to the fused kernels: FlashAttention for unpadded batches and the
+    # memory-efficient kernel (which supports the padding mask) otherwise.
+    if args.cpu_only:
+        attention_backends = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION, SDPBackend.MATH]
+    else:
+        attention_backends = [SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION]
+    with torch.inference_mode(), sdpa_kernel(attention_backends):
+        if not args.cpu_only:
+            # One short forward pass first, so lazy initialization, kernel selection and allocator warmup
+            # do not land on (and skew the timing of) the first real batch.
+            # The warmup shape is not captured, so it does not take one of the CUDA graph slots.
+            logger.info("Warming up")
+            if cuda_graphs is not None:
+                cuda_graphs.enabled = False
+            with torch.cuda.stream(stream_compute):
+                with torch.autocast("cuda", dtype=autocast_dtype, enabled=use_autocast):
+                    forward_encoded(model, encode_batch(["M" * 32], pin_memory=True), num_recycles=1)
+            stream_compute.synchronize()
+            torch.cuda.empty_cache()
+            if cuda_graphs is not None:
+                cuda_graphs.enabled = True
+
+        for headers, sequences in batched_sequences:
+            start = timer()
+            chunk_size = args.chunk_size
+            if chunk_size is None:
+                chunk_size = select_chunk_size(max(len(seq) for seq in sequences))
+            batch = encode_batch(sequences, pin_memory=not args.cpu_only)
+            # torch.cuda.stream initializes CUDA even for a None stream, which a CPU-only run must not do.
+            stream_context = contextlib.nullcontext() if args.cpu_only else torch.cuda.stream(stream_compute)
+            with stream_context:
+                with torch.autocast("cuda", dtype=autocast_dtype, enabled=use_autocast):
+                    predictions = safe_infer(
+                        model, headers, sequences, batch, args.num_recycles, chunk_size, start
+                    )
+
+            copy_done = None
+            if stream_compute is not None:
+                copy_done = torch.cuda.Event()
+                copy_done.record(stream_compute)
+            for batch_headers, batch_sequences, output, batch_start in predictions:
+                future = executor.submit(
+                    write_pdbs, output, batch_headers, args.pdb, batch_start, copy_done, pdb_executor
+                )
+                if pending is not None:
+                    log_batch(*pending)
+                pending = (future, batch_headers, batch_sequences, output)
+    if pending is not None:
+        log_batch(*pending)
+    executor.shutdown(wait=True)
+    if pdb_executor is not None:
+        pdb_executor.shutdown(wait=True)
+
+    if num_completed == 0:
+        logger.warning("No sequences completed, leaving the fasta unchanged")
+        return pLDDT_dict, pTM_dict
+    avg_pLDDT = pLDDT_sum / num_completed
+    avg_pTM = pTM_sum / num_completed
     logger.info(f'Average pLDDT: {avg_pLDDT}\nAverage pTM: {avg_pTM}\n')
 
-    # Add pLDDT and pTM annotations to sequences
-    sequences_with_annotations = parse_fasta(args.fasta)
-    for seq in sequences_with_annotations:
-        seq_id = seq['id']
+    # Add pLDDT and pTM annotations to the sequences read at the start and rewrite the fasta in one go
+    fasta_entries = []
+    for header, seq in records:
+        seq_id, annotations = _parse_header(header)
         if seq_id in pLDDT_dict:
-            seq['annotations']['pLDDT'] = f"{pLDDT_dict[seq_id]:0.1f}"
-            seq['annotations']['pTM'] = f"{pTM_dict[seq_id]:0.3f}"
-
-    write_fasta(sequences_with_annotations, args.fasta)
+            annotations['pLDDT'] = f"{pLDDT_dict[seq_id]:0.1f}"
+            annotations['pTM'] = f"{pTM_dict[seq_id]:0.3f}"
+        fasta_entries.append(f">{_format_header(seq_id, annotations)}\n{seq}\n")
+    args.fasta.write_text(''.join(fasta_entries))
 
     return pLDDT_dict, pTM_dict
 
@@ -0,0 +1,18 @@
+# Copyright (c) 2025 Institute for AI Industry Research (AIR), Tsinghua University, and AI For Science Group, Shanghai Artificial Intelligence Laboratory
+# SPDX-License-Identifier: Apache-2.0
+
+# PDB formatting for the worker processes of fold_eval_tts.py. Kept apart from the script so that the
+# workers only need torch and ESMFold's output_to_pdb, not the model, attention or batching code.
+import torch
+from esm.esmfold.v1.misc import output_to_pdb
+
+
+def init_pdb_worker():
+    # PDB formatting is a handful of tiny tensor ops per sequence; intra-op threads would only contend.
+    torch.set_num_threads(1)
+
+
+def format_pdb(output, output_file):
+    # Writes one sequence's structure; `output` holds that sequence's numpy outputs.
+    output = {key: torch.from_numpy(value) for key, value in output.items()}
+    output_file.write_text(output_to_pdb(output)[0])